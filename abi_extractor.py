@@ -1,6 +1,7 @@
 import json
 import os
-import requests
+
+from http_session import REQUEST_TIMEOUT, SESSION
 
 try:
     from dotenv import load_dotenv
@@ -46,7 +47,7 @@ def extract_contract_abi(contract_address: str) -> dict:
     """
     url = (f'https://api.basescan.org/api?module=contract&action=getabi'
            f'&address={contract_address}&apikey={BASESCAN_API_KEY}')
-    response = requests.get(url)
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
     data = response.json()
     if not data.get('result'):
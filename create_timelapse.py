@@ -1,19 +1,23 @@
+import functools
 import json
 import os
-import pickle
+import re
 import sys
+import time
 
 from collections import defaultdict
-from typing import Optional
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import AbstractSet, List, Optional, Tuple
 
-import requests
+import numpy as np
 from web3 import Web3
-from datetime import datetime
 import argparse
 
 from web3.contract import Contract
+from web3.exceptions import Web3RPCError
 
 from abi_extractor import extract_contract_abi
+from http_session import REQUEST_TIMEOUT, SESSION
 from timelaps_render import render_timelapse_frames, TimelapseSettings
 
 # basepaint contract address
@@ -24,9 +28,28 @@ CONTRACT_ADDRESS = '0xBa5e05cb26b78eDa3A2f8e3b3814726305dcAc83'
 # https://basescan.org/tx/0x4f9052feb5b3b20f79fabc175438824badebcf840e478f36b0f3731ae524e14b
 CONTRACT_CREATION_BLOCK = 2385188
 # This value is valid on the time of writing,
-# if you are getting ValueError: {'code': -32000, 'message': 'block range too large'}
-# you should lower this value
+# ranges rejected with {'code': -32000, 'message': 'block range too large'}
+# are split in half and retried, lowering this value avoids those extra requests
 EVENT_LOG_MAX_BLOCKS_INTERVAL = 2000
+# Cached scans lagging behind by at most this many blocks are refreshed with a single eth_getLogs request.
+# Off by default, https://mainnet.base.org rejects ranges above EVENT_LOG_MAX_BLOCKS_INTERVAL,
+# set it through the environment for providers accepting wider ranges
+EVENT_LOG_MAX_ONE_CALL_BLOCKS = int(os.environ.get('EVENT_LOG_MAX_ONE_CALL_BLOCKS', 0))
+# Number of concurrent eth_getLogs requests, keep it within the RPC provider's rate limit
+EVENT_LOG_FETCH_WORKERS = 16
+# Number of concurrent requests to the basepaint.xyz theme API
+THEME_FETCH_WORKERS = 16
+# Each painted pixel is stored as an (x, y, color_index) row
+PAINT_EVENT_FIELDS = 3
+# Painted events are cached at cwd/.cache, every checkpoint adds one day_<day>_<from block>_<to block>.npz
+# shard per day it found events for, and a small json keeps the scan progress
+CACHE_DIR = ".cache"
+CACHE_META_FILE = "meta.json"
+CACHE_SHARD_PATTERN = re.compile(r"day_(\d+)_(\d+)_(\d+)\.npz")
+# Days loaded from more shards than this are rewritten into a single shard
+CACHE_MAX_DAY_SHARDS = 8
+# Number of block windows scanned between two cache checkpoints
+CACHE_CHECKPOINT_WINDOWS = 4 * EVENT_LOG_FETCH_WORKERS
 
 
 def load_contract_abi(use_latest: bool = False) -> dict:
@@ -40,56 +63,239 @@ def load_contract_abi(use_latest: bool = False) -> dict:
             return json.load(f)
 
 
+@functools.lru_cache(maxsize=None)
 def retrieve_day_theme_and_palette(day_number: int) -> tuple:
     """
     Fetch theme and palette for a specific day.
     """
     url = f'https://basepaint.xyz/api/theme/{day_number}'
-    response = requests.get(url)
+    response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
-    return response.json()['palette'], response.json()['theme']
+    data = response.json()
+    return data['palette'], data['theme']
 
 
-def retrieve_contract_paint_events(w3: Web3, contract: Contract, latest_block: int) -> tuple:
+def split_block_range(from_block: int, to_block: int, interval: int) -> List[Tuple[int, int]]:
     """
-    Fetch painted events from the contract.
+    Split the inclusive [from_block, to_block] range into inclusive sub-ranges of at most `interval` blocks.
     """
-    CACHE_DIR = ".cache"
-    CACHE_FILE = "paint_events_cache.pkl"
+    return [(i, min(i + interval - 1, to_block)) for i in range(from_block, to_block + 1, interval)]
 
-    day2paint_events = defaultdict(list)
-    day2block = {}
-    start_from_block = CONTRACT_CREATION_BLOCK
 
-    # Check if there is a cache at cwd/.cache
-    cache_path = os.path.join(CACHE_DIR, CACHE_FILE)
-    if os.path.exists(cache_path):
-        with open(cache_path, "rb") as f:
-            day2paint_events, day2block = pickle.load(f)
-            start_from_block = max(day2block.values()) + 1  # +1 to start from the next block
+def fetch_painted_events(contract: Contract, from_block: int, to_block: int) -> list:
+    """
+    Fetch painted events in the inclusive block range, halving the range whenever the RPC rejects it.
+    """
+    try:
+        return contract.events.Painted.get_logs(from_block=from_block, to_block=to_block)
+    except (ValueError, Web3RPCError):
+        if from_block == to_block:
+            raise
+        middle = (from_block + to_block) // 2
+        return fetch_painted_events(contract, from_block, middle) + fetch_painted_events(contract, middle + 1, to_block)
+
+
+def retrieve_block_timestamps(w3: Web3, block_numbers: List[int]) -> List[int]:
+    """
+    Fetch the timestamps of the given blocks in a single batched RPC request.
+    """
+    if not block_numbers:
+        return []
+    with w3.batch_requests() as batch:
+        batch.add_mapping({w3.eth.get_block: block_numbers})
+        return [block['timestamp'] for block in batch.execute()]
+
 
-    for i in range(start_from_block, latest_block, EVENT_LOG_MAX_BLOCKS_INTERVAL):
+def list_paint_events_shards() -> List[Tuple[int, int, int, str]]:
+    """
+    List the cached shards as (day, from block, to block, path), in chain order with the widest range first.
+    """
+    if not os.path.isdir(CACHE_DIR):
+        return []
+    shards = []
+    for name in os.listdir(CACHE_DIR):
+        match = CACHE_SHARD_PATTERN.fullmatch(name)
+        if match:
+            day, from_block, to_block = map(int, match.groups())
+            shards.append((day, from_block, to_block, os.path.join(CACHE_DIR, name)))
+    return sorted(shards, key=lambda shard: (shard[0], shard[1], -shard[2]))
+
+
+def load_paint_events_cache() -> tuple:
+    """
+    Load the cached day timestamps and the last scanned block.
+    """
+    meta_path = os.path.join(CACHE_DIR, CACHE_META_FILE)
+    day2block, last_scanned_block = {}, CONTRACT_CREATION_BLOCK - 1
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+        day2block = {int(day): timestamp for day, timestamp in meta['day2block'].items()}
+        last_scanned_block = meta['last_scanned_block']
+
+    # Shards past the scan progress come from an interrupted checkpoint, those blocks are scanned again
+    for _, _, shard_to_block, shard_path in list_paint_events_shards():
+        if shard_to_block > last_scanned_block:
+            try:
+                os.remove(shard_path)
+            except OSError:
+                pass
+    return day2block, last_scanned_block
+
+
+def write_paint_events_shard(day: int, from_block: int, to_block: int,
+                             events: np.ndarray, event_blocks: np.ndarray) -> None:
+    """
+    Write the events of a day found in the inclusive block range, along with the block of each event.
+    """
+    shard_path = os.path.join(CACHE_DIR, f"day_{day}_{from_block}_{to_block}.npz")
+    with open(shard_path + ".tmp", "wb") as f:
+        np.savez_compressed(f, paint_events=events, blocks=event_blocks)
+    os.replace(shard_path + ".tmp", shard_path)
+
+
+def load_day_paint_events(day: int, shards: List[Tuple[int, int, str]]) -> np.ndarray:
+    """
+    Load the events of a day from its (from block, to block, path) shards, in chain order.
+    """
+    paint_events, paint_event_blocks = [], []
+    covered_to_block = -1
+    for from_block, to_block, shard_path in shards:
+        # Runs started from the same scan progress write overlapping shards, keep each block once
+        if to_block <= covered_to_block:
+            continue
+        with np.load(shard_path) as shard:
+            events, event_blocks = shard['paint_events'], shard['blocks']
+        if from_block <= covered_to_block:
+            is_new = event_blocks > covered_to_block
+            events, event_blocks = events[is_new], event_blocks[is_new]
+        paint_events.append(events)
+        paint_event_blocks.append(event_blocks)
+        covered_to_block = to_block
+
+    paint_events = np.concatenate(paint_events)
+    if len(shards) > CACHE_MAX_DAY_SHARDS:
         try:
-            painted_events = contract.events.Painted.get_logs(fromBlock=i, toBlock=i + EVENT_LOG_MAX_BLOCKS_INTERVAL)
-        except ValueError:
-            raise Exception("Update EVENT_LOG_MAX_BLOCKS_INTERVAL constant")
+            write_paint_events_shard(day, shards[0][0], covered_to_block,
+                                     paint_events, np.concatenate(paint_event_blocks))
+            merged_name = f"day_{day}_{shards[0][0]}_{covered_to_block}.npz"
+            for _, _, shard_path in shards:
+                if os.path.basename(shard_path) != merged_name:
+                    os.remove(shard_path)
+        except OSError:
+            pass
+    return paint_events
 
-        for event in painted_events:
-            if event.args.day not in day2block:
-                block_data = w3.eth.get_block(event.blockNumber)
-                day2block[event.args.day] = block_data['timestamp']
-            pixels = event.args.pixels
-            for x, y, color_index in zip(pixels[0::3], pixels[1::3], pixels[2::3]):
-                day2paint_events[event.args.day].append((x, y, color_index))
 
+def load_cached_paint_events(days: Optional[AbstractSet[int]]) -> dict:
+    """
+    Load the cached painted events of the given days (every cached day when None) as lists of chunks.
+    """
+    day2shards = defaultdict(list)
+    for day, from_block, to_block, shard_path in list_paint_events_shards():
+        if days is None or day in days:
+            day2shards[day].append((from_block, to_block, shard_path))
+
+    day2paint_events = defaultdict(list)
+    for day, shards in day2shards.items():
+        day2paint_events[day].append(load_day_paint_events(day, shards))
+    return day2paint_events
+
+
+def save_paint_events_cache(new_paint_events: dict,
+                            day2block: dict,
+                            from_block: int,
+                            to_block: int) -> None:
+    """
+    Write the (events, event blocks) of each day found in the checkpoint range as new shards,
+    then record the scan progress.
+    """
     try:
-        if not os.path.exists(CACHE_DIR):
-            os.makedirs(CACHE_DIR)
-        with open(cache_path, "wb") as f:
-            pickle.dump((day2paint_events, day2block), f)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for day, (events, event_blocks) in new_paint_events.items():
+            write_paint_events_shard(day, from_block, to_block, events, event_blocks)
+
+        meta_path = os.path.join(CACHE_DIR, CACHE_META_FILE)
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump({'last_scanned_block': to_block, 'day2block': day2block}, f)
+        os.replace(meta_path + ".tmp", meta_path)
     except (PermissionError, FileExistsError, OSError):
         pass
 
+
+def store_paint_events(w3: Web3,
+                       painted_events_batches,
+                       day2paint_events: dict,
+                       day2block: dict,
+                       from_block: int,
+                       to_block: int,
+                       days: Optional[AbstractSet[int]]) -> None:
+    """
+    Checkpoint the painted events of consecutive block ranges, keeping the chunks of the requested days.
+    """
+    first_block_of_day = {}
+    new_paint_events = defaultdict(list)
+    new_paint_event_blocks = defaultdict(list)
+    for painted_events in painted_events_batches:
+        for event in painted_events:
+            if event.args.day not in day2block and event.args.day not in first_block_of_day:
+                first_block_of_day[event.args.day] = event.blockNumber
+            # pixels is a flat x, y, color_index, x, y, color_index, ... byte string
+            pixels = event.args.pixels
+            num_values = len(pixels) // PAINT_EVENT_FIELDS * PAINT_EVENT_FIELDS
+            new_paint_events[event.args.day].append(
+                np.frombuffer(pixels, dtype=np.uint8, count=num_values).reshape(-1, PAINT_EVENT_FIELDS))
+            new_paint_event_blocks[event.args.day].append((event.blockNumber, num_values // PAINT_EVENT_FIELDS))
+
+    timestamps = retrieve_block_timestamps(w3, list(first_block_of_day.values()))
+    day2block.update(zip(first_block_of_day.keys(), timestamps))
+
+    new_paint_events = {day: np.concatenate(events) for day, events in new_paint_events.items()}
+    event_blocks = {}
+    for day, blocks_and_counts in new_paint_event_blocks.items():
+        blocks, counts = zip(*blocks_and_counts)
+        event_blocks[day] = np.repeat(np.array(blocks, dtype=np.uint32), counts)
+    save_paint_events_cache({day: (events, event_blocks[day]) for day, events in new_paint_events.items()},
+                            day2block, from_block, to_block)
+    for day, events in new_paint_events.items():
+        if days is None or day in days:
+            day2paint_events[day].append(events)
+
+
+def retrieve_contract_paint_events(w3: Web3,
+                                   contract: Contract,
+                                   latest_block: int,
+                                   days: Optional[AbstractSet[int]] = None) -> tuple:
+    """
+    Fetch painted events from the contract, only the events of the given days are loaded (every day when None).
+    """
+    day2block, last_scanned_block = load_paint_events_cache()
+    day2paint_events = load_cached_paint_events(days)
+    start_from_block = last_scanned_block + 1
+
+    # When enabled, a short refresh is tried as a single request. If the provider rejects the range
+    # anyway, the delta is scanned in windows instead
+    if EVENT_LOG_MAX_BLOCKS_INTERVAL < latest_block - start_from_block + 1 <= EVENT_LOG_MAX_ONE_CALL_BLOCKS:
+        try:
+            painted_events = contract.events.Painted.get_logs(from_block=start_from_block, to_block=latest_block)
+        except (ValueError, Web3RPCError):
+            pass
+        else:
+            store_paint_events(w3, [painted_events], day2paint_events, day2block,
+                               start_from_block, latest_block, days)
+            start_from_block = latest_block + 1
+
+    block_ranges = split_block_range(start_from_block, latest_block, EVENT_LOG_MAX_BLOCKS_INTERVAL)
+    with ThreadPoolExecutor(max_workers=EVENT_LOG_FETCH_WORKERS) as executor:
+        # Checkpoint the cache every few windows, so an interrupted scan resumes from the last checkpoint
+        for i in range(0, len(block_ranges), CACHE_CHECKPOINT_WINDOWS):
+            checkpoint_ranges = block_ranges[i:i + CACHE_CHECKPOINT_WINDOWS]
+            # map keeps the ranges order, so events of a day are appended in chain order
+            painted_events_batches = executor.map(lambda r: fetch_painted_events(contract, *r), checkpoint_ranges)
+            store_paint_events(w3, painted_events_batches, day2paint_events, day2block,
+                               checkpoint_ranges[0][0], checkpoint_ranges[-1][1], days)
+
+    day2paint_events = {day: np.concatenate(events) for day, events in day2paint_events.items()}
     return day2paint_events, day2block
 
 
@@ -101,21 +307,23 @@ def connect_to_web3(provider_url: str) -> Web3:
     return w3
 
 
-def generate_timelapse_video(output_path: str,
+def generate_timelapse_video(absolute_output_path: str,
                              day_number: int,
-                             day2block: dict,
-                             painted_events: dict,
-                             timelapse_settings: TimelapseSettings):
-    timestamp = datetime.utcfromtimestamp(day2block.get(day_number))
-    formatted_timestamp = timestamp.strftime('%Y-%m-%d') if timestamp else "UNKNOWN_DATE"
-
-    palette, theme = retrieve_day_theme_and_palette(day_number)
-    absolute_output_path = os.path.join(os.getcwd(), output_path)
-    os.makedirs(absolute_output_path, exist_ok=True)
+                             day_timestamp: Optional[int],
+                             day_paint_events: np.ndarray,
+                             palette: List[str],
+                             theme: str,
+                             timelapse_settings: TimelapseSettings,
+                             encoder_threads: Optional[int] = None):
+    if day_timestamp is not None:
+        timestamp = time.gmtime(day_timestamp)
+        formatted_timestamp = f"{timestamp.tm_year:04d}-{timestamp.tm_mon:02d}-{timestamp.tm_mday:02d}"
+    else:
+        formatted_timestamp = "UNKNOWN_DATE"
 
     video_path = os.path.join(absolute_output_path, f"{formatted_timestamp}_#{day_number}_{theme}.mp4")
 
-    render_timelapse_frames(video_path, painted_events[day_number], palette, timelapse_settings)
+    render_timelapse_frames(video_path, day_paint_events, palette, timelapse_settings, encoder_threads)
 
 
 def main(output_path: str, day_number: Optional[int], timelapse_settings: TimelapseSettings):
@@ -123,14 +331,33 @@ def main(output_path: str, day_number: Optional[int], timelapse_settings: Timela
     abi = load_contract_abi()
     contract = w3.eth.contract(address=CONTRACT_ADDRESS, abi=abi)
     latest_block = w3.eth.get_block('latest')['number']
-    painted_events, day2block = retrieve_contract_paint_events(w3, contract, latest_block)
+    absolute_output_path = os.path.abspath(output_path)
+    os.makedirs(absolute_output_path, exist_ok=True)
+    no_paint_events = np.empty((0, PAINT_EVENT_FIELDS), dtype=np.uint8)
     if day_number is None:
-        # get the day number from contract and loop through each day
+        # get the day number from contract and render the days in parallel, each one is independent
+        painted_events, day2block = retrieve_contract_paint_events(w3, contract, latest_block)
         day_number = contract.functions.today().call()
-        for i in range(1, day_number + 1):
-            generate_timelapse_video(output_path, i, day2block, painted_events, timelapse_settings)
+        days = range(1, day_number + 1)
+        # The theme requests are latency bound, fetch them all up front instead of one per rendered day
+        with ThreadPoolExecutor(max_workers=THEME_FETCH_WORKERS) as executor:
+            day_themes = list(executor.map(retrieve_day_theme_and_palette, days))
+        # One day per core with a single-threaded encode each, ffmpeg's default of one encoder thread
+        # per core would otherwise oversubscribe the CPU by the number of workers
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            # Submit each day with its own events only, so the whole event dict is not pickled per task
+            futures = [executor.submit(generate_timelapse_video, absolute_output_path, i, day2block.get(i),
+                                       painted_events.get(i, no_paint_events), palette, theme, timelapse_settings,
+                                       encoder_threads=1)
+                       for i, (palette, theme) in zip(days, day_themes)]
+            for future in futures:
+                future.result()
     else:
-        generate_timelapse_video(output_path, day_number, day2block, painted_events, timelapse_settings)
+        # Only the requested day is read back from the cache
+        painted_events, day2block = retrieve_contract_paint_events(w3, contract, latest_block, {day_number})
+        palette, theme = retrieve_day_theme_and_palette(day_number)
+        generate_timelapse_video(absolute_output_path, day_number, day2block.get(day_number),
+                                 painted_events.get(day_number, no_paint_events), palette, theme, timelapse_settings)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,20 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Timeout in seconds for the BaseScan and basepaint.xyz API calls
+REQUEST_TIMEOUT = 10
+
+
+def create_session() -> requests.Session:
+    """
+    Create a session that keeps its connections alive between calls and retries transient failures.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.3))
+    session.mount('https://', adapter)
+    return session
+
+
+# Shared by every API call, so consecutive requests to the same host reuse one TCP/TLS connection
+SESSION = create_session()
@@ -1,9 +1,22 @@
 from dataclasses import dataclass
 import numpy as np
 import imageio
-from typing import Tuple, List
+from typing import Optional, Tuple, List
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, without it frames are painted with batched numpy fills
+    njit = None
 
 RGB_LENGTH = 3
+# Extra ffmpeg output options. The canvas is made of flat color blocks, so the cheapest
+# (nearest neighbor) swscale is enough for the rgb24 to yuv420p conversion
+FFMPEG_PARAMS = ['-profile:v', 'high', '-tune', 'animation', '-crf', '20', '-sws_flags', 'neighbor']
+# Frames are encoded at the canvas resolution times the scale factor, nearest neighbor scaling
+# replicates each canvas pixel into a flat block and the pad filter rounds odd frame sizes up
+# to the even size yuv420p requires
+FFMPEG_VIDEO_FILTER = 'scale={width}:{height}:flags=neighbor,pad=ceil(iw/2)*2:ceil(ih/2)*2'
 
 
 @dataclass
@@ -34,71 +47,111 @@ def hex_to_rgb(value: str) -> Tuple[int, int, int]:
     return tuple(int(value[i:i + length // RGB_LENGTH], 16) for i in range(0, length, length // RGB_LENGTH))
 
 
-def get_nearest_size_divisible_by_16(dim: int) -> int:
-    """Get the nearest size divisible by 16.
+def palette_to_rgb(palette: List[str]) -> np.ndarray:
+    """Convert a palette of hexadecimal colors to an RGB lookup table.
 
     Parameters:
-        dim (int): Original dimension.
+        palette (List[str]): List of color values in hexadecimal.
 
     Returns:
-        int: Adjusted dimension.
+        np.ndarray: Array of shape (len(palette), 3), indexable by color index.
     """
-    return int(np.ceil(dim / 16.0)) * 16
+    return np.array([hex_to_rgb(color) for color in palette], dtype=np.uint8).reshape(-1, RGB_LENGTH)
 
 
-def draw_pixel_on_canvas(canvas: np.ndarray, x: int, y: int, color: str, scale_factor: int) -> np.ndarray:
-    """Draw a pixel on the given canvas using the specified color.
+def draw_pixels_on_canvas(canvas: np.ndarray,
+                          xs: np.ndarray,
+                          ys: np.ndarray,
+                          colors: np.ndarray) -> np.ndarray:
+    """Draw a batch of pixels on the given canvas.
 
     Parameters:
         canvas (np.ndarray): The canvas to draw on.
-        x (int): X-coordinate.
-        y (int): Y-coordinate.
-        color (str): Color value in hexadecimal.
-        scale_factor (int): Scaling factor for pixel.
+        xs (np.ndarray): X-coordinates.
+        ys (np.ndarray): Y-coordinates.
+        colors (np.ndarray): RGB values, one row per pixel.
 
     Returns:
         np.ndarray: Updated canvas.
     """
-    upscale_x, upscale_y = x * scale_factor, y * scale_factor
-    canvas[upscale_y:upscale_y + scale_factor, upscale_x:upscale_x + scale_factor] = hex_to_rgb(color)
+    canvas[ys, xs] = colors
     return canvas
 
 
+def draw_events_on_canvas(canvas: np.ndarray,
+                          events: np.ndarray,
+                          palette_rgb: np.ndarray) -> np.ndarray:
+    """Draw events on the given canvas one by one, compiled with numba when it is installed.
+
+    Parameters:
+        canvas (np.ndarray): The canvas to draw on.
+        events (np.ndarray): Array of shape (N, 3), each row holds x, y coordinates and color index.
+        palette_rgb (np.ndarray): RGB lookup table indexed by color index.
+
+    Returns:
+        np.ndarray: Updated canvas.
+    """
+    for k in range(events.shape[0]):
+        x, y = events[k, 0], events[k, 1]
+        color = palette_rgb[events[k, 2]]
+        for channel in range(RGB_LENGTH):
+            canvas[y, x, channel] = color[channel]
+    return canvas
+
+
+if njit is not None:
+    draw_events_on_canvas = njit(cache=True)(draw_events_on_canvas)
+
+
 def render_timelapse_frames(output_path: str,
-                            events: List[Tuple[int, int, int]],
+                            events: np.ndarray,
                             palette: List[str],
-                            settings: TimelapseSettings) -> None:
+                            settings: TimelapseSettings,
+                            encoder_threads: Optional[int] = None) -> None:
     """Creates a timelapse video from the events and the palette provided.
 
     Parameters:
         output_path (str): Path to save the generated video.
-        events (list): List of events where each event is a tuple of x, y coordinates and color index.
+        events (np.ndarray): Array of shape (N, 3), each row holds x, y coordinates and color index.
         palette (list): List of color values.
         settings (TimelapseSettings): Settings for video rendering.
+        encoder_threads (Optional[int]): Number of libx264 threads, ffmpeg picks one per core when None.
     """
-    if len(events) == 0:
+    num_frames = settings.desired_duration * settings.frame_rate
+    # Too few events to fill the requested duration, nothing gets encoded
+    if len(events) < num_frames:
         return
 
-    max_x, max_y = max(events, key=lambda p: p[0])[0], max(events, key=lambda p: p[1])[1]
-    width, height = max_x + 1, max_y + 1
+    events = np.asarray(events, dtype=np.int32)
+
+    max_x, max_y = events[:, :2].max(axis=0)
+    width, height = int(max_x) + 1, int(max_y) + 1
     upscale_width, upscale_height = width * settings.scale_factor, height * settings.scale_factor
 
-    upscale_width = get_nearest_size_divisible_by_16(upscale_width)
-    upscale_height = get_nearest_size_divisible_by_16(upscale_height)
+    # The canvas stays at the drawing resolution, ffmpeg upscales each frame while encoding
+    canvas = np.zeros((height, width, 3), dtype=np.uint8)
 
-    canvas = np.zeros((upscale_height, upscale_width, 3), dtype=np.uint8)
-
-    num_frames = len(events)
-    events_per_frame = num_frames // (settings.desired_duration * settings.frame_rate)
-    if events_per_frame == 0:
-        return
+    palette_rgb = palette_to_rgb(palette)
+    # Color indices come from the chain while the palette comes from basepaint.xyz, check them once here:
+    # the numba loop does not bounds check and would read past the palette instead of raising
+    max_color_index = int(events[:, 2].max())
+    if max_color_index >= len(palette_rgb):
+        raise IndexError(f"Color index {max_color_index} is out of range for a palette of {len(palette_rgb)} colors")
 
+    ffmpeg_params = FFMPEG_PARAMS + ['-vf', FFMPEG_VIDEO_FILTER.format(width=upscale_width, height=upscale_height)]
+    if encoder_threads is not None:
+        ffmpeg_params += ['-threads', str(encoder_threads)]
     with imageio.get_writer(output_path, fps=settings.frame_rate, codec='libx264', quality=7,
-                            ffmpeg_params=['-profile:v', 'high', '-tune', 'animation', '-crf', '20']) as writer:
-        for i, (x, y, color_index) in enumerate(events):
-            color = palette[color_index]
-            canvas = draw_pixel_on_canvas(canvas, x, y, color, settings.scale_factor)
-
-            if i % events_per_frame == 0:
+                            macro_block_size=1, ffmpeg_params=ffmpeg_params) as writer:
+        # Paint each frame's share of the events in one batch, then write the frame once
+        if njit is not None:
+            for frame_events in np.array_split(events, num_frames):
+                canvas = draw_events_on_canvas(canvas, frame_events, palette_rgb)
+                writer.append_data(canvas)
+        else:
+            # Resolve the color of every event up front, painting a frame is then a plain copy of its rows
+            colors = palette_rgb[events[:, 2]]
+            for frame_events, frame_colors in zip(np.array_split(events, num_frames),
+                                                  np.array_split(colors, num_frames)):
+                canvas = draw_pixels_on_canvas(canvas, frame_events[:, 0], frame_events[:, 1], frame_colors)
                 writer.append_data(canvas)
-